@@ -1,6 +1,17 @@
+# Serve with a WSGI server from the repository root, e.g.
+#   gunicorn -w $(nproc) -k gthread --threads 4 -b 0.0.0.0:5000 backend.NextGenFItness:app
+# Don't use --preload: each worker must open its own SQLite connections.
 from flask import Flask, request, jsonify
 from flask_cors import CORS
-from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.security import check_password_hash
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import atexit
+import json
+import os
+import queue
 import sqlite3
 import base64
 
@@ -8,124 +19,309 @@ import base64
 app = Flask(__name__)
 CORS(app)
 
-def get_db_connection():
-    conn = sqlite3.connect('backend/NextGenFitness.db')
+DB_PATH = 'backend/NextGenFitness.db'
+READ_POOL_SIZE = 4
+
+def get_db_connection(read_only=False):
+    # Autocommit connection that can be handed between request threads
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None)
+    # busy_timeout is per-connection, so contended writers wait instead of failing
+    conn.execute("PRAGMA busy_timeout=5000")
+    # WAL is persistent in the db file; lets readers run alongside a writer
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    # 20 MB page cache, kept warm across requests by the pools below
+    conn.execute("PRAGMA cache_size=-20000")
+    # Read pages through mmap rather than read() syscalls, keep temp tables in RAM
+    conn.execute("PRAGMA mmap_size=268435456")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA trusted_schema=OFF")
+    # Single-column rows come back as the bare value instead of a 1-tuple
+    conn.row_factory = lambda cursor, row: row[0] if len(row) == 1 else row
+    if read_only:
+        conn.execute("PRAGMA query_only=1")
     return conn
 
+# Connections are opened once and reused so each request skips the connect
+# cost and keeps a warm page cache. SQLite only allows one writer at a time,
+# so writes queue on a single connection while WAL serves reads in parallel.
+WRITE_POOL = queue.Queue(maxsize=1)
+WRITE_POOL.put(get_db_connection())
+READ_POOL = queue.Queue(maxsize=READ_POOL_SIZE)
+for _ in range(READ_POOL_SIZE):
+    READ_POOL.put(get_db_connection(read_only=True))
+
+@atexit.register
+def close_pools():
+    # Skip the writer if a request still holds it rather than hang shutdown
+    try:
+        conn = WRITE_POOL.get(timeout=5)
+    except queue.Empty:
+        conn = None
+    if conn is not None:
+        # Lets SQLite refresh query planner statistics if they have gone stale
+        conn.execute("PRAGMA optimize")
+        conn.close()
+    while not READ_POOL.empty():
+        READ_POOL.get().close()
+
+# Argon2id cost, defaulting to OWASP-recommended parameters. Raise these on
+# faster hardware; existing hashes are upgraded on the user's next login.
+PW_HASH_TIME_COST = int(os.environ.get('PW_HASH_TIME_COST', 3))
+PW_HASH_MEMORY_KIB = int(os.environ.get('PW_HASH_MEMORY_KIB', 64 * 1024))
+PH = PasswordHasher(time_cost=PW_HASH_TIME_COST, memory_cost=PW_HASH_MEMORY_KIB,
+                    parallelism=2, hash_len=32, salt_len=16)
+
+# Verified against on unknown usernames so a miss costs as much as a real check
+DUMMY_HASH = PH.hash('x' * 16)
+
+# argon2-cffi releases the GIL while hashing, so hashes from concurrent requests
+# run on separate cores. The cap is per process: with N gunicorn workers, up to
+# N * cpu_count hashes (each holding PW_HASH_MEMORY_KIB) can be in flight.
+HASH_POOL = ThreadPoolExecutor(max_workers=os.cpu_count())
+
+def hash_password(password):
+    return HASH_POOL.submit(PH.hash, password).result()
+
+def verify_password(stored_hash, password):
+    return HASH_POOL.submit(_verify_password, stored_hash, password).result()
+
+def _verify_password(stored_hash, password):
+    # Returns (matches, needs_rehash)
+    if stored_hash.startswith('$argon2'):
+        try:
+            PH.verify(stored_hash, password)
+        except (VerificationError, InvalidHashError):
+            return False, False
+        return True, PH.check_needs_rehash(stored_hash)
+    # Hashes written by werkzeug before the switch to Argon2id
+    return check_password_hash(stored_hash, password), True
+
+@contextmanager
+def _checkout(pool):
+    conn = pool.get()
+    try:
+        yield conn.cursor()
+    finally:
+        # Never hand a connection back with a transaction still open
+        if conn.in_transaction:
+            conn.rollback()
+        pool.put(conn)
+
+def read_conn():
+    return _checkout(READ_POOL)
+
+def write_conn():
+    return _checkout(WRITE_POOL)
+
+@contextmanager
+def write_transaction():
+    # Takes the write lock up front so everything in the block commits as one
+    # unit; write_conn rolls back instead if the block raises
+    with write_conn() as c:
+        c.execute("BEGIN IMMEDIATE")
+        yield c
+        c.execute("COMMIT")
+
+# SQL lives in constants so every request sends identical text and hits the
+# pooled connection's prepared statement cache instead of re-parsing.
+# The next user_id (U001, U002, ...) is generated in the INSERT itself so
+# concurrent signups can't be handed the same id; a taken username or email
+# hits a UNIQUE index and inserts nothing. (WHERE true is needed for SQLite
+# to parse ON CONFLICT after a SELECT.)
+SQL_INSERT_USER = """
+    INSERT INTO User (user_id, username, email, password, role)
+    SELECT printf('U%03d', COALESCE(MAX(CAST(SUBSTR(user_id, 2) AS INTEGER)), 0) + 1), ?, ?, ?, ?
+    FROM User WHERE true
+    ON CONFLICT DO NOTHING
+    RETURNING user_id
+"""
+SQL_USERNAME_EXISTS = "SELECT EXISTS(SELECT 1 FROM User WHERE username = ?)"
+SQL_LOOKUP_BY_USER = "SELECT user_id, password FROM User WHERE username = ?"
+SQL_EMAIL_EXISTS = "SELECT 1 FROM User WHERE email = ? LIMIT 1"
+SQL_UPDATE_PW = "UPDATE User SET password = ? WHERE email = ?"
+# Only replaces the hash that was verified, so a concurrent reset isn't undone
+SQL_REHASH_PW = "UPDATE User SET password = ? WHERE user_id = ? AND password = ?"
+SQL_LAST_PROFILE_ID = "SELECT profile_id FROM Profile ORDER BY profile_id DESC LIMIT 1"
+SQL_PROFILE_EXISTS = "SELECT 1 FROM Profile WHERE user_id = ? LIMIT 1"
+SQL_UPDATE_PROFILE = """
+    UPDATE Profile SET full_name=?, age=?, gender=?, height=?, weight=?, bmi=?, location=?, profile_picture=?
+    WHERE user_id=?
+"""
+SQL_INSERT_PROFILE = """
+    INSERT INTO Profile (profile_id, user_id, full_name, age, gender, height, weight, bmi, location, profile_picture)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+def _json_error(message, status):
+    # Encoded once at import; Flask still builds a fresh Response per request
+    body = json.dumps({'error': message}, separators=(',', ':')).encode() + b'\n'
+    return body, status, {'Content-Type': 'application/json'}
+
+ERR_USERNAME_TAKEN = _json_error('Username already exists', 409)
+ERR_EMAIL_TAKEN = _json_error('Email already registered', 409)
+ERR_BAD_CREDS = _json_error('Invalid username or password', 401)
+ERR_EMAIL_NOT_FOUND = _json_error('Email not found', 404)
+ERR_RESET_FIELDS = _json_error('Email and new password are required', 400)
+ERR_PROFILE_FIELDS = _json_error('Missing required fields', 400)
+ERR_INVALID_FIELDS = _json_error('Missing or invalid fields', 400)
+
+# Hash cost grows with input length, so oversized fields are rejected up front
+MAX_FIELD_LENGTH = 256
+
+def required_fields(data, *keys):
+    # Returns the values for keys, or None if any is missing, not a string or too long
+    if not isinstance(data, dict):
+        return None
+    values = [data.get(key) for key in keys]
+    if all(isinstance(value, str) and 0 < len(value) <= MAX_FIELD_LENGTH for value in values):
+        return values
+    return None
+
+# False if existing duplicate usernames kept init_db from making them UNIQUE
+USERNAMES_UNIQUE = True
+
+SQL_INDEX_NAMES = "SELECT name FROM sqlite_master WHERE type = 'index'"
+
+def create_unique_index(conn, name, table, column):
+    # Rows written before the index existed may hold duplicates. Fall back to a
+    # plain index so startup still succeeds; UNIQUE is retried on every start.
+    try:
+        conn.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS {name} ON {table}({column})")
+    except sqlite3.IntegrityError:
+        app.logger.warning("Duplicate %s.%s values found; using a non-unique index until "
+                           "they are resolved", table, column)
+        conn.execute(f"CREATE INDEX IF NOT EXISTS {name}_nonunique ON {table}({column})")
+        return False
+    conn.execute(f"DROP INDEX IF EXISTS {name}_nonunique")
+    return True
+
 def init_db():
     conn = get_db_connection()
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS User
-                (user_id Text,
+    existing_indexes = set(conn.execute(SQL_INDEX_NAMES).fetchall())
+    # One script so startup parses and runs the schema in a single call
+    conn.executescript('''
+        CREATE TABLE IF NOT EXISTS User
+                (user_id TEXT PRIMARY KEY,
                 username TEXT, 
                 email Text Unique,
                 password TEXT,
-                role INTEGER)''')
-    conn.commit()
+                role INTEGER);
+        -- Lets signup find the highest numeric user_id with one index lookup
+        CREATE INDEX IF NOT EXISTS idx_user_id_num
+                ON User(CAST(SUBSTR(user_id, 2) AS INTEGER));
+        CREATE TABLE IF NOT EXISTS Profile
+                (profile_id TEXT PRIMARY KEY,
+                user_id TEXT NOT NULL,
+                full_name TEXT NOT NULL,
+                age INTEGER,
+                gender TEXT,
+                height REAL,
+                weight REAL,
+                bmi REAL,
+                location TEXT,
+                profile_picture TEXT,
+                FOREIGN KEY (user_id) REFERENCES User(user_id));
+    ''')
+    # Index rather than a column constraint so existing databases get it too
+    global USERNAMES_UNIQUE
+    USERNAMES_UNIQUE = create_unique_index(conn, 'idx_user_username', 'User', 'username')
+    # save_profile looks up the single profile for a user on every save
+    create_unique_index(conn, 'idx_profile_user', 'Profile', 'user_id')
+    # Give newly created indexes planner statistics; later startups skip this
+    if set(conn.execute(SQL_INDEX_NAMES).fetchall()) - existing_indexes:
+        conn.execute("ANALYZE")
     conn.close()
 
 @app.route('/signup', methods=['POST'])
 def signup():
-    data = request.get_json()
-    username = data.get('username')
-    email = data.get('email')
-    password = generate_password_hash(data.get('password'))
-    role = int(data.get('role', 1))
+    data = request.get_json(silent=True)
+    fields = required_fields(data, 'username', 'email', 'password')
+    if fields is None:
+        return ERR_INVALID_FIELDS
+    username, email, password = fields
+    try:
+        role = int(data.get('role', 1))
+    except (TypeError, ValueError):
+        return ERR_INVALID_FIELDS
+    password = hash_password(password)
 
-    conn = get_db_connection()
-    c = conn.cursor()
-
-    # Check if username exists
-    c.execute("SELECT * FROM User WHERE username = ?", (username,))
-    if c.fetchone():
-        conn.close()
-        return jsonify({'error': 'Username already exists'}), 409
+    with write_transaction() as c:
+        # Without the UNIQUE index the INSERT can't reject a taken username itself
+        username_taken = not USERNAMES_UNIQUE and c.execute(SQL_USERNAME_EXISTS, (username,)).fetchone()
+        new_user_id = None
+        if not username_taken:
+            # Insert user
+            new_user_id = c.execute(SQL_INSERT_USER, (username, email, password, role)).fetchone()
+            if new_user_id is None:
+                username_taken = c.execute(SQL_USERNAME_EXISTS, (username,)).fetchone()
 
-    # Check if email exists
-    c.execute("SELECT * FROM User WHERE email = ?", (email,))
-    if c.fetchone():
-        conn.close()
-        return jsonify({'error': 'Email already registered'}), 409
-
-    # Generate new user_id
-    c.execute("SELECT user_id FROM User ORDER BY user_id DESC LIMIT 1")
-    last = c.fetchone()
-    if last and last[0]:
-        last_num = int(last[0][1:])  # Remove 'U' and convert to int
-        new_num = last_num + 1
-    else:
-        new_num = 1
-    new_user_id = f"U{new_num:03d}"
-
-    # Insert user
-    c.execute("INSERT INTO User (user_id, username, email, password, role) VALUES (?, ?, ?, ?, ?)",
-              (new_user_id, username, email, password, role))
-    conn.commit()
-    conn.close()
+    if new_user_id is None:
+        if username_taken:
+            return ERR_USERNAME_TAKEN
+        return ERR_EMAIL_TAKEN
 
     return jsonify({'message': 'User registered successfully', 'user_id': new_user_id}), 201
 
 @app.route('/login', methods=['POST'])
 def login():
-    data = request.get_json()
-    username = data.get('username')
-    password = data.get('password')
+    fields = required_fields(request.get_json(silent=True), 'username', 'password')
+    if fields is None:
+        return ERR_INVALID_FIELDS
+    username, password = fields
 
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute("SELECT user_id, password FROM User WHERE username = ?", (username,))
-    user = c.fetchone()
-    conn.close()
+    with read_conn() as c:
+        user = c.execute(SQL_LOOKUP_BY_USER, (username,)).fetchone()
 
-    if user and check_password_hash(user[1], password):
+    if user:
+        matches, needs_rehash = verify_password(user[1], password)
+    else:
+        # Keeps response timing from revealing which usernames exist
+        verify_password(DUMMY_HASH, password)
+        matches = needs_rehash = False
+    if matches:
+        if needs_rehash:
+            # Hash before checking out the writer so other writes aren't held up
+            new_hash = hash_password(password)
+            with write_conn() as c:
+                c.execute(SQL_REHASH_PW, (new_hash, user[0], user[1]))
         return jsonify({'message': 'Login successful', 'user_id': user[0]}), 200
     else:
-        return jsonify({'error': 'Invalid username or password'}), 401
+        return ERR_BAD_CREDS
     
 @app.route('/forgot-password', methods=['POST'])
 def forgot_password():
-    data = request.get_json()
-    email = data.get('email')
+    fields = required_fields(request.get_json(silent=True), 'email')
+    if fields is None:
+        return ERR_INVALID_FIELDS
+    email, = fields
 
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute("SELECT * FROM User WHERE email = ?", (email,))
-    user = c.fetchone()
-    conn.close()
+    with read_conn() as c:
+        user = c.execute(SQL_EMAIL_EXISTS, (email,)).fetchone()
 
     if user:
         return jsonify({'message': 'Email found'}), 200
     else:
-        return jsonify({'error': 'Email not found'}), 404
+        return ERR_EMAIL_NOT_FOUND
     
 @app.route('/reset-password', methods=['POST'])
 def reset_password():
-    data = request.get_json()
-    email = data.get('email')
-    new_password = data.get('new_password')
-
-    if not email or not new_password:
-        return jsonify({'error': 'Email and new password are required'}), 400
+    fields = required_fields(request.get_json(silent=True), 'email', 'new_password')
+    if fields is None:
+        return ERR_RESET_FIELDS
+    email, new_password = fields
 
-    hashed_password = generate_password_hash(new_password)
+    hashed_password = hash_password(new_password)
 
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute("UPDATE User SET password = ? WHERE email = ?", (hashed_password, email))
-    conn.commit()
-    conn.close()
+    with write_conn() as c:
+        c.execute(SQL_UPDATE_PW, (hashed_password, email))
 
     return jsonify({'message': 'Password has been successfully updated'}), 200
 
-def generate_profile_id():
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute("SELECT profile_id FROM Profile ORDER BY profile_id DESC LIMIT 1")
-    last_id_row = c.fetchone()
-    conn.close()
+def generate_profile_id(c):
+    last_id = c.execute(SQL_LAST_PROFILE_ID).fetchone()  # e.g., "P005"
 
-    if last_id_row:
-        last_id = last_id_row[0]  # e.g., "P005"
+    if last_id:
         numeric_part = int(last_id[1:]) + 1   # get "005", convert to 5, add 1
         return f'P{numeric_part:03d}'         # pad to "P006"
     else:
@@ -143,7 +339,7 @@ def save_profile():
     location = request.form.get('location')
 
     if not user_id or not full_name:
-        return jsonify({'error': 'Missing required fields'}), 400
+        return ERR_PROFILE_FIELDS
 
     # Handle profile_picture file
     profile_picture_file = request.files.get('profile_picture')
@@ -161,32 +357,21 @@ def save_profile():
         except:
             bmi = None
 
-    conn = get_db_connection()
-    cur = conn.cursor()
-
-    # Check if profile exists
-    cur.execute("SELECT * FROM Profile WHERE user_id = ?", (user_id,))
-    existing_profile = cur.fetchone()
-
-    if existing_profile:
-        # Update
-        cur.execute("""
-            UPDATE Profile SET full_name=?, age=?, gender=?, height=?, weight=?, bmi=?, location=?, profile_picture=?
-            WHERE user_id=?
-        """, (full_name, age, gender, height, weight, bmi, location, profile_picture_base64, user_id))
-    else:
-        # Insert new profile_id
-        profile_id = generate_profile_id()
-        cur.execute("""
-            INSERT INTO Profile (profile_id, user_id, full_name, age, gender, height, weight, bmi, location, profile_picture)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (profile_id, user_id, full_name, age, gender, height, weight, bmi, location, profile_picture_base64))
-
-    conn.commit()
-    conn.close()
+    # One transaction so the existence check, the new profile_id and the
+    # write can't interleave with another save
+    with write_transaction() as cur:
+        # Check if profile exists
+        existing_profile = cur.execute(SQL_PROFILE_EXISTS, (user_id,)).fetchone()
+
+        if existing_profile:
+            # Update
+            cur.execute(SQL_UPDATE_PROFILE, (full_name, age, gender, height, weight, bmi, location, profile_picture_base64, user_id))
+        else:
+            # Insert new profile_id
+            profile_id = generate_profile_id(cur)
+            cur.execute(SQL_INSERT_PROFILE, (profile_id, user_id, full_name, age, gender, height, weight, bmi, location, profile_picture_base64))
 
     return jsonify({'message': 'Profile saved successfully'}), 200
 
-if __name__ == '__main__':
-    init_db()
-    app.run(debug=True)
+# Runs on import so every WSGI worker sees the schema before serving
+init_db()